@@ -1,7 +1,8 @@
 import numpy as np
+from scipy.special import stdtrit
 from experiment_toolkit import (
     required_sample_size, minimum_detectable_effect,
-    t_test, cuped_adjust, diff_in_diff
+    t_test, cuped_adjust, diff_in_diff, aa_simulation
 )
 
 # 1. Power and sample size calculations
@@ -15,35 +16,10 @@ print(f"To detect an effect of {effect} with 80% power at 5% significance, each
 print(f"For 100 samples per group, the minimum detectable effect (80% power, 5% alpha) is ~{mde_for_100:.3f}.")
 
 # 2. A/A test simulation (to check false positive rate and CI coverage)
-np.random.seed(0)
 iterations = 1000
 n_per_group = 50
-false_positives = 0
-ci_misses = 0
 alpha = 0.05
-for i in range(iterations):
-    # Simulate two groups with identical distributions (no true effect)
-    control = np.random.normal(0, 1, n_per_group)
-    treatment = np.random.normal(0, 1, n_per_group)
-    # Perform t-test
-    _, p_val = t_test(control, treatment)
-    if p_val < alpha:
-        false_positives += 1
-    # Construct 95% confidence interval for the difference in means
-    diff = treatment.mean() - control.mean()
-    # Pooled variance estimate for two-sample t (for CI calculation)
-    pooled_var = (((n_per_group-1)*np.var(control, ddof=1) + (n_per_group-1)*np.var(treatment, ddof=1))
-                  / (2*n_per_group - 2))
-    se_diff = np.sqrt(pooled_var * (2 / n_per_group))
-    # 95% t critical value
-    from scipy.stats import t
-    df = 2 * n_per_group - 2
-    t_crit = t.ppf(1 - alpha/2, df)
-    ci_lower = diff - t_crit * se_diff
-    ci_upper = diff + t_crit * se_diff
-    # Check if true difference (0) is outside the CI
-    if ci_lower > 0 or ci_upper < 0:
-        ci_misses += 1
+false_positives, ci_misses = aa_simulation(iterations, n_per_group, alpha=alpha, seed=0)
 
 fp_rate = false_positives / iterations * 100
 ci_coverage = 100 - (ci_misses / iterations * 100)
@@ -52,58 +28,80 @@ print(f"95% CI coverage over {iterations} A/A tests: {ci_coverage:.1f}% (expecte
 
 
 # 2b. Simple A/B (non-null) demo
-np.random.seed(3)
+rng = np.random.default_rng(3)
 n = 200
 true_effect = 0.20  # treatment mean lift
-control = np.random.normal(0, 1, n)
-treatment = np.random.normal(true_effect, 1, n)
+control = rng.standard_normal(n)
+treatment = rng.standard_normal(n) + true_effect
 stat, p = t_test(control, treatment)
 
 # Welch 95% CI for the mean difference
-s0 = np.var(control, ddof=1); s1 = np.var(treatment, ddof=1)
+s0, s1 = np.stack([control, treatment]).var(axis=1, ddof=1)
 se = np.sqrt(s0/n + s1/n)
 df = (s0/n + s1/n)**2 / ((s0**2)/((n**2)*(n-1)) + (s1**2)/((n**2)*(n-1)))
-from scipy.stats import t
-tcrit = t.ppf(0.975, df)
+tcrit = stdtrit(df, 0.975)
 diff = treatment.mean() - control.mean()
 print(f"A/B effect ≈ {diff:.3f} (95% CI [{diff - tcrit*se:.3f}, {diff + tcrit*se:.3f}]), p={p:.3g}")
 
 
 # 3. CUPED variance reduction demonstration
-np.random.seed(1)
+def _pooled_var(a, b):
+    """Population variance of a and b combined (along the last axis), without concatenating."""
+    na, nb = a.shape[-1], b.shape[-1]
+    n = na + nb
+    # Per-group variances pooled with the parallel-variance combine of the group means
+    mean_gap = a.mean(axis=-1) - b.mean(axis=-1)
+    return (na * a.var(axis=-1) + nb * b.var(axis=-1) + mean_gap**2 * na * nb / n) / n
+
+rng = np.random.default_rng(1)
 N = 1000  # samples per group for demonstration
+# Draw baselines and outcome noise for both groups in one block: rows are
+# [baseline_ctrl, baseline_treat, noise_ctrl, noise_treat]
+noise = rng.standard_normal((4, N))
 # Simulate a baseline metric (pre-experiment) and an outcome that depends on the baseline
-baseline_ctrl = np.random.normal(0, 1, N)
-baseline_treat = np.random.normal(0, 1, N)
+baseline_ctrl, baseline_treat, e_ctrl, e_treat = noise
 # Outcome has a true relationship with baseline (e.g., correlation ~0.5), no actual treatment effect for this demo
-outcome_ctrl = 0.5 * baseline_ctrl + np.random.normal(0, 1, N)
-outcome_treat = 0.5 * baseline_treat + np.random.normal(0, 1, N)
+outcome_ctrl = 0.5 * baseline_ctrl + e_ctrl
+outcome_treat = 0.5 * baseline_treat + e_treat
 # Apply CUPED adjustment
 adj_ctrl, adj_treat, theta = cuped_adjust(baseline_ctrl, outcome_ctrl, baseline_treat, outcome_treat)
 # Calculate variance before and after adjustment
-var_before = np.var(np.concatenate([outcome_ctrl, outcome_treat]))
-var_after = np.var(np.concatenate([adj_ctrl, adj_treat]))
+var_before = _pooled_var(outcome_ctrl, outcome_treat)
+var_after = _pooled_var(adj_ctrl, adj_treat)
 reduction_percent = (1 - var_after/var_before) * 100
 print(f"CUPED adjustment coefficient theta = {theta:.3f}")
 print(f"Variance before CUPED: {var_before:.3f}, after: {var_after:.3f} (reduced by ~{reduction_percent:.1f}%)")
 
+# Repeat the CUPED demo over K replications in one batched call
+K = 200
+b_ctrl, b_treat, e_ctrl, e_treat = np.moveaxis(rng.standard_normal((K, 4, N)), 1, 0)
+o_ctrl, o_treat = 0.5 * b_ctrl + e_ctrl, 0.5 * b_treat + e_treat
+adj_ctrl_k, adj_treat_k, theta_k = cuped_adjust(b_ctrl, o_ctrl, b_treat, o_treat)
+var_before_k = _pooled_var(o_ctrl, o_treat)
+var_after_k = _pooled_var(adj_ctrl_k, adj_treat_k)
+reduction_k = (1 - var_after_k/var_before_k) * 100
+print(f"Over {K} CUPED replications: mean theta = {theta_k.mean():.3f}, "
+      f"variance reduced by ~{reduction_k.mean():.1f}% (sd {reduction_k.std():.1f}%)")
+
 # 4. Difference-in-Differences simulation
-np.random.seed(2)
+rng = np.random.default_rng(2)
 n_ctrl_units = 50
 n_treat_units = 50
-# Each unit has a random baseline level (unit fixed effect)
-unit_effect_ctrl = np.random.normal(0, 2, n_ctrl_units)
-unit_effect_treat = np.random.normal(0, 2, n_treat_units)
+# One draw for all units: rows are [unit effect, pre-period noise, post-period noise],
+# columns are control units followed by treatment units
+unit_effect, noise_pre, noise_post = rng.standard_normal((3, n_ctrl_units + n_treat_units))
+# Each unit has a random baseline level (unit fixed effect, sd 2)
+unit_effect = 2 * unit_effect
+unit_effect_ctrl, unit_effect_treat = unit_effect[:n_ctrl_units], unit_effect[n_ctrl_units:]
 time_effect = 3.0      # common trend affecting all units in post period
 treatment_effect = 5.0 # true treatment effect applied to treatment group in post period
 # Generate pre-period outcomes
-pre_control = unit_effect_ctrl + np.random.normal(0, 1, n_ctrl_units)
-pre_treatment = unit_effect_treat + np.random.normal(0, 1, n_treat_units)
+pre_control = unit_effect_ctrl + noise_pre[:n_ctrl_units]
+pre_treatment = unit_effect_treat + noise_pre[n_ctrl_units:]
 # Generate post-period outcomes (add time effect to both, and treatment effect to treatment group)
-post_control = unit_effect_ctrl + time_effect + np.random.normal(0, 1, n_ctrl_units)
-post_treatment = unit_effect_treat + time_effect + treatment_effect + np.random.normal(0, 1, n_treat_units)
+post_control = unit_effect_ctrl + time_effect + noise_post[:n_ctrl_units]
+post_treatment = unit_effect_treat + time_effect + treatment_effect + noise_post[n_ctrl_units:]
 # Compute diff-in-diff estimate and significance
-diff_est, t_stat, p_val = diff_in_diff(pre_control, post_control, pre_treatment, post_treatment)
-print(f"Diff-in-diff estimate: {diff_est:.2f} (true effect was {treatment_effect})")
+diff_est, t_stat, p_val, ci_lo, ci_hi = diff_in_diff(pre_control, post_control, pre_treatment, post_treatment)
+print(f"Diff-in-diff estimate: {diff_est:.2f} (95% CI [{ci_lo:.2f}, {ci_hi:.2f}], true effect was {treatment_effect})")
 print(f"T-statistic: {t_stat:.2f}, p-value: {p_val:.2e}")
-
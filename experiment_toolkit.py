@@ -1,8 +1,37 @@
 
+from functools import lru_cache
+from typing import Union
+
 import numpy as np
-import scipy.stats as st
+from numpy.typing import ArrayLike
+from scipy.special import ndtr, ndtri, stdtr, stdtrit
+
+@lru_cache(maxsize=256)
+def _z_pair(alpha: float, power: float):
+    """
+    Standard normal critical values (Z_alpha/2, Z_beta) for a scalar two-sided design.
+    ndtri is the normal quantile ufunc (same values as scipy.stats.norm.ppf, without the
+    distribution-object overhead); results are cached per (alpha, power).
+    """
+    return float(ndtri(1 - alpha/2)), float(ndtri(power))
+
+# Precomputed (Z_alpha/2, Z_beta) for the usual design choices; other pairs fall back to _z_pair
+_COMMON_Z = {(a, p): (float(ndtri(1 - a/2)), float(ndtri(p)))
+             for a in (0.01, 0.025, 0.05, 0.1) for p in (0.8, 0.9, 0.95)}
 
-def required_sample_size(effect: float, sigma: float, alpha: float = 0.05, power: float = 0.8) -> float:
+def _z_values(alpha: ArrayLike, power: ArrayLike):
+    """
+    (Z_alpha/2, Z_beta) for scalar or array alpha/power: table/cache lookup for scalars,
+    a single vectorized ndtri call per quantile for arrays.
+    """
+    if np.ndim(alpha) == 0 and np.ndim(power) == 0:
+        alpha, power = float(alpha), float(power)
+        return _COMMON_Z.get((alpha, power)) or _z_pair(alpha, power)
+    alpha, power = np.asarray(alpha, dtype=float), np.asarray(power, dtype=float)
+    return ndtri(1 - alpha/2), ndtri(power)
+
+def required_sample_size(effect: ArrayLike, sigma: ArrayLike, alpha: ArrayLike = 0.05,
+                         power: ArrayLike = 0.8) -> Union[float, np.ndarray]:
     """
     Calculate required sample size per group for a two-sample t-test (two-sided)
     to detect a given effect with specified power and significance level.
@@ -10,16 +39,19 @@ def required_sample_size(effect: float, sigma: float, alpha: float = 0.05, power
     - sigma: standard deviation of the outcome (assumed same for both groups).
     - alpha: significance level (two-sided, e.g., 0.05 for 5%).
     - power: desired statistical power (e.g., 0.8 for 80%).
-    Returns: required sample size per group (float).
+    All arguments may be arrays; they broadcast against each other (e.g. a design grid).
+    Returns: required sample size per group (float, or array of the broadcast shape).
     """
-    # Z critical values for significance and power
-    Z_alpha2 = st.norm.ppf(1 - alpha/2)   # two-tailed critical value
-    Z_beta = st.norm.ppf(power)          # one-tailed for power (beta = 1-power)
+    # Z critical values for significance and power:
+    # two-tailed critical value, and one-tailed for power (beta = 1-power)
+    Z_alpha2, Z_beta = _z_values(alpha, power)
+    effect, sigma = np.asarray(effect, dtype=float), np.asarray(sigma, dtype=float)
     # Sample size formula for two-sample difference in means (approximate using normal)
     n_per_group = 2 * ((Z_alpha2 + Z_beta) * sigma / effect) ** 2
     return n_per_group
 
-def minimum_detectable_effect(n_per_group: int, sigma: float, alpha: float = 0.05, power: float = 0.8) -> float:
+def minimum_detectable_effect(n_per_group: ArrayLike, sigma: ArrayLike, alpha: ArrayLike = 0.05,
+                              power: ArrayLike = 0.8) -> Union[float, np.ndarray]:
     """
     Calculate the minimum detectable effect size for a given per-group sample size,
     significance level, and power in a two-sample test.
@@ -27,65 +59,143 @@ def minimum_detectable_effect(n_per_group: int, sigma: float, alpha: float = 0.0
     - sigma: standard deviation of the outcome.
     - alpha: significance level (two-sided).
     - power: desired power.
-    Returns: minimum detectable difference in means.
+    All arguments may be arrays; they broadcast against each other (e.g. a design grid).
+    Returns: minimum detectable difference in means (float, or array of the broadcast shape).
     """
-    Z_alpha2 = st.norm.ppf(1 - alpha/2)
-    Z_beta = st.norm.ppf(power)
+    Z_alpha2, Z_beta = _z_values(alpha, power)
+    n_per_group, sigma = np.asarray(n_per_group, dtype=float), np.asarray(sigma, dtype=float)
     # Rearranged formula to solve for effect size given n
     mde = (Z_alpha2 + Z_beta) * sigma * np.sqrt(2 / n_per_group)
     return mde
 
+def _welch(a: np.ndarray, b: np.ndarray):
+    """
+    Welch two-sample t-test of mean(a) - mean(b), computed from the raw formula.
+    Returns: (t_statistic, p_value, df, se, diff) as Python floats.
+    """
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    if a.ndim != 1 or b.ndim != 1:
+        raise ValueError("expected 1-D samples; use welch_t_test_batch for batched data")
+    n1, n2 = a.size, b.size
+    m1, m2 = a.mean(), b.mean()
+    v1, v2 = a.var(ddof=1), b.var(ddof=1)
+    se = np.sqrt(v1/n1 + v2/n2)
+    diff = m1 - m2
+    t = diff / se
+    # Welch-Satterthwaite df
+    df = (v1/n1 + v2/n2)**2 / ((v1/n1)**2/(n1-1) + (v2/n2)**2/(n2-1))
+    p = 2 * stdtr(df, -abs(t))
+    return float(t), float(p), float(df), float(se), float(diff)
+
 def t_test(control: np.ndarray, treatment: np.ndarray):
     """
     Perform a two-sample Welch's t-test for difference in means between control and treatment.
     - control, treatment: numpy arrays of observations for each group.
-    Returns: (t_statistic, p_value)
+    Returns: (t_statistic, p_value), with the statistic for control - treatment
+    (the scipy.stats.ttest_ind(control, treatment) sign convention).
     """
-    stat, p_val = st.ttest_ind(control, treatment, equal_var=False)
+    stat, p_val, _, _, _ = _welch(control, treatment)
     return stat, p_val
 
+def permutation_test(control: np.ndarray, treatment: np.ndarray, B: int = 9999,
+                     seed=None, chunk_size: int = 1000):
+    """
+    Two-sided Monte Carlo permutation test for a difference in means.
+    - control, treatment: numpy arrays of observations for each group.
+    - B: number of random permutations.
+    - seed: seed or np.random.Generator used for the permutations.
+    - chunk_size: permutations evaluated per batch (bounds memory to chunk_size x N).
+    Returns: (mean_difference, p_value) with mean_difference = control - treatment
+    (same sign convention as t_test) and p_value = (1 + #{|T*| >= |T_obs|}) / (1 + B).
+    """
+    control, treatment = np.asarray(control, dtype=float), np.asarray(treatment, dtype=float)
+    if control.size == 0 or treatment.size == 0:
+        raise ValueError("control and treatment must both be non-empty")
+    combined = np.concatenate([control, treatment])
+    N, n1 = combined.size, control.size
+    total = combined.sum()
+    # Same sum-based formula as the permuted statistics, so ties compare consistently
+    c_obs = control.sum()
+    t_obs = c_obs/n1 - (total - c_obs)/(N - n1)
+    # Relative tolerance so splits tying with the observed one are counted despite rounding
+    threshold = abs(t_obs) * (1 - 1e-14)
+    rng = np.random.default_rng(seed)
+    exceed = 0
+    for start in range(0, B, chunk_size):
+        k = min(chunk_size, B - start)
+        # The n1 smallest keys of each row give a uniformly random control assignment
+        idx = np.argpartition(rng.random((k, N)), n1, axis=1)[:, :n1]
+        c_sums = combined[idx].sum(axis=1)
+        t_perm = c_sums/n1 - (total - c_sums)/(N - n1)
+        exceed += int((np.abs(t_perm) >= threshold).sum())
+    return float(t_obs), (1 + exceed) / (1 + B)
+
+def _moments2(x: np.ndarray, y: np.ndarray):
+    """
+    Centered moments of a paired (x, y) sample along the last axis.
+    Returns: (n, mean_x, mean_y, sxx, sxy) with sxx = sum((x - mean_x)**2) and
+    sxy = sum((x - mean_x) * (y - mean_y)), each with the batch shape of x and y.
+    """
+    mean_x, mean_y = x.mean(axis=-1), y.mean(axis=-1)
+    dx, dy = x - mean_x[..., None], y - mean_y[..., None]
+    return (x.shape[-1], mean_x, mean_y,
+            np.einsum('...i,...i->...', dx, dx), np.einsum('...i,...i->...', dx, dy))
+
 def cuped_adjust(control_pre: np.ndarray, control_post: np.ndarray,
                  treatment_pre: np.ndarray, treatment_post: np.ndarray):
     """
     Apply CUPED adjustment using pre-experiment data.
     - control_pre, control_post: arrays for control group (pre-period metric and post-period outcome).
     - treatment_pre, treatment_post: arrays for treatment group (pre-period metric and post-period outcome).
-    Returns: (adjusted_control_post, adjusted_treatment_post, theta).
-    """
-    # Combine data to calculate overall theta
-    X = np.concatenate([control_pre, treatment_pre])
-    Y = np.concatenate([control_post, treatment_post])
-    theta = np.cov(X, Y, bias=True)[0, 1] / np.var(X)  # Cov(X,Y)/Var(X)
-    # Compute grand mean of baseline
-    X_mean = np.mean(X)
-    # Adjust outcomes
-    Y_adjusted = Y - theta * (X - X_mean)
-    # Split adjusted outcomes back into control and treatment sets
-    n_control = len(control_post)
-    Y_adj_control = Y_adjusted[:n_control]
-    Y_adj_treatment = Y_adjusted[n_control:]
+    Arrays may carry leading batch dimensions, shape (..., n_control) and (..., n_treatment);
+    each batch entry is adjusted independently along the last axis.
+    Returns: (adjusted_control_post, adjusted_treatment_post, theta), theta with the batch shape.
+    """
+    control_pre, control_post = np.asarray(control_pre), np.asarray(control_post)
+    treatment_pre, treatment_post = np.asarray(treatment_pre), np.asarray(treatment_post)
+    # Pool the centered moments of both groups to calculate overall theta (no concatenation),
+    # using the parallel (Chan et al.) combine so large baseline means do not cancel
+    n_c, mx_c, my_c, sxx_c, sxy_c = _moments2(control_pre, control_post)
+    n_t, mx_t, my_t, sxx_t, sxy_t = _moments2(treatment_pre, treatment_post)
+    n = n_c + n_t
+    dmx, dmy = mx_t - mx_c, my_t - my_c
+    X_mean = mx_c + dmx * n_t / n          # grand mean of baseline
+    sxx = sxx_c + sxx_t + dmx**2 * n_c * n_t / n
+    sxy = sxy_c + sxy_t + dmx * dmy * n_c * n_t / n
+    theta = sxy / sxx                      # Cov(X,Y)/Var(X)
+    # Adjust outcomes of each group directly, broadcasting theta over the unit axis
+    theta_b, X_mean_b = theta[..., None], X_mean[..., None]
+    Y_adj_control = control_post - theta_b * (control_pre - X_mean_b)
+    Y_adj_treatment = treatment_post - theta_b * (treatment_pre - X_mean_b)
     return Y_adj_control, Y_adj_treatment, theta
 
+# p-value of a z statistic for each alternative (tests p2 - p1)
+_Z_TAILS = {
+    "two-sided": lambda z: 2 * ndtr(-np.abs(z)),
+    "larger": lambda z: ndtr(-z),    # H1: p2 - p1 > 0
+    "smaller": lambda z: ndtr(z),    # H1: p2 - p1 < 0
+}
 
-def two_prop_z_test(x1: int, n1: int, x2: int, n2: int, alternative: str = "two-sided"):
+def two_prop_z_test(x1: ArrayLike, n1: ArrayLike, x2: ArrayLike, n2: ArrayLike,
+                    alternative: str = "two-sided"):
     """
     Two-proportion z-test (pooled standard error).
     x1, n1: successes and trials in group 1
     x2, n2: successes and trials in group 2
+    Counts may be scalars or broadcastable arrays (one test per element).
     alternative: 'two-sided' | 'larger' | 'smaller' (tests p2 - p1)
     Returns: (z_stat, p_value)
     """
+    try:
+        tail = _Z_TAILS[alternative]
+    except KeyError:
+        raise ValueError(f"alternative must be one of {sorted(_Z_TAILS)}, got {alternative!r}") from None
+    x1, n1, x2, n2 = (np.asarray(v, dtype=float) for v in (x1, n1, x2, n2))
     p1, p2 = x1 / n1, x2 / n2
     p_pool = (x1 + x2) / (n1 + n2)
     se = np.sqrt(p_pool * (1 - p_pool) * (1/n1 + 1/n2))
     z = (p2 - p1) / se
-    if alternative == "two-sided":
-        p = 2 * (1 - st.norm.cdf(abs(z)))
-    elif alternative == "larger":   # H1: p2 - p1 > 0
-        p = 1 - st.norm.cdf(z)
-    else:                           # H1: p2 - p1 < 0
-        p = st.norm.cdf(z)
-    return z, p
+    return z, tail(z)
     
 def diff_in_diff(pre_control: np.ndarray, post_control: np.ndarray,
                  pre_treatment: np.ndarray, post_treatment: np.ndarray,
@@ -97,17 +207,82 @@ def diff_in_diff(pre_control: np.ndarray, post_control: np.ndarray,
     change_control = post_control - pre_control
     change_treatment = post_treatment - pre_treatment
 
-    diff_effect = np.mean(change_treatment) - np.mean(change_control)
-
     # Welch t test on change scores
-    n1, n0 = len(change_treatment), len(change_control)
-    s1, s0 = np.var(change_treatment, ddof=1), np.var(change_control, ddof=1)
-    se = np.sqrt(s1/n1 + s0/n0)
-    t_stat = diff_effect / se
-    # Welch-Satterthwaite df
-    df = (s1/n1 + s0/n0)**2 / ((s1**2)/((n1**2)*(n1-1)) + (s0**2)/((n0**2)*(n0-1)))
-    p_val = 2 * (1 - st.t.cdf(abs(t_stat), df))
-    tcrit = st.t.ppf(1 - alpha/2, df)
+    t_stat, p_val, df, se, diff_effect = _welch(change_treatment, change_control)
+    tcrit = float(stdtrit(df, 1 - alpha/2))
     ci_lower, ci_upper = diff_effect - tcrit*se, diff_effect + tcrit*se
 
     return diff_effect, t_stat, p_val, ci_lower, ci_upper
+
+def _welch_batch(data: np.ndarray, alpha: float):
+    """
+    Welch t-test of group 1 - group 0 along the last axis of a (..., 2, n) array.
+    Returns: (diff, t_stats, p_values, ci_lower, ci_upper)
+    """
+    n = data.shape[-1]
+    means = data.mean(axis=-1)
+    vars_ = data.var(axis=-1, ddof=1)
+    diff = means[..., 1] - means[..., 0]
+    se2 = vars_ / n
+    se = np.sqrt(se2.sum(axis=-1))
+    t_stats = diff / se
+    # Welch-Satterthwaite df
+    df = se**4 / (se2**2 / (n - 1)).sum(axis=-1)
+    p_values = 2 * stdtr(df, -np.abs(t_stats))
+    tcrit = stdtrit(df, 1 - alpha/2)
+    return diff, t_stats, p_values, diff - tcrit*se, diff + tcrit*se
+
+def welch_t_test_batch(data: np.ndarray, alpha: float = 0.05):
+    """
+    Welch t-tests and CIs for a batch of two-group experiments in one vectorized pass.
+    - data: array of shape (..., 2, n) with axes [..., group (control/treatment), unit].
+    - alpha: significance level (two-sided) for the confidence intervals.
+    Returns: (t_stats, p_values, ci_lower, ci_upper) for control - treatment
+    (same sign convention as t_test), each with the leading batch shape of data.
+    """
+    data = np.asarray(data, dtype=float)
+    # _welch_batch tests group 1 - group 0; reverse the group axis (a view) for control - treatment
+    _, t_stats, p_values, ci_lower, ci_upper = _welch_batch(data[..., ::-1, :], alpha)
+    return t_stats, p_values, ci_lower, ci_upper
+
+def diff_in_diff_batched(data: np.ndarray, alpha: float = 0.05):
+    """
+    Difference-in-Differences on stacked panel data, with Welch CI on the change scores.
+    - data: array of shape (..., 2, 2, n) with axes [..., group (control/treatment),
+      period (pre/post), unit]; both groups need the same number of units.
+    Returns: (effect, t_stat, p_value, ci_lower, ci_upper), each with the leading batch shape.
+    """
+    data = np.asarray(data, dtype=float)
+    changes = data[..., 1, :] - data[..., 0, :]   # (..., 2, n) change scores per group
+    return _welch_batch(changes, alpha)
+
+def aa_simulation(iterations: int, n_per_group: int, alpha: float = 0.05,
+                  seed=None, chunk_size: int = 10_000):
+    """
+    A/A Monte Carlo check of the Welch t-test and the pooled-variance CI.
+    - iterations: number of simulated A/A experiments.
+    - n_per_group: sample size in each group (standard normal outcomes, no true effect).
+    - alpha: significance level (two-sided).
+    - seed: seed or np.random.Generator used for the draws.
+    - chunk_size: number of experiments simulated per batch (bounds memory use).
+    Returns: (false_positives, ci_misses)
+    """
+    rng = np.random.default_rng(seed)
+    df = 2 * n_per_group - 2
+    t_crit = stdtrit(df, 1 - alpha/2)   # constant across runs
+    false_positives = 0
+    ci_misses = 0
+    for start in range(0, iterations, chunk_size):
+        k = min(chunk_size, iterations - start)
+        # axes: [iteration, group (control/treatment), unit]
+        data = rng.standard_normal((k, 2, n_per_group))
+        _, p_vals, _, _ = welch_t_test_batch(data, alpha)
+        false_positives += int((p_vals < alpha).sum())
+        # Pooled variance estimate for two-sample t (for CI calculation)
+        diff = data[:, 1].mean(axis=-1) - data[:, 0].mean(axis=-1)
+        pooled_var = data.var(axis=-1, ddof=1).mean(axis=-1)
+        se_diff = np.sqrt(pooled_var * (2 / n_per_group))
+        ci_lower, ci_upper = diff - t_crit * se_diff, diff + t_crit * se_diff
+        # Check if true difference (0) is outside the CI
+        ci_misses += int(((ci_lower > 0) | (ci_upper < 0)).sum())
+    return false_positives, ci_misses